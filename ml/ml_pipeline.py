@@ -51,6 +51,11 @@ class SengonMLPipeline:
             'learning_rate': 0.001
         }
         
+        self.resample_config = {
+            'freq': '1h',  # Grid spacing, matches the hourly sequence_length
+            'max_gap_steps': 3  # Longest gap (in grid slots) that is filled
+        }
+        
         self.rf_config = {
             'n_estimators': 200,
             'max_depth': 10,
@@ -59,6 +64,13 @@ class SengonMLPipeline:
             'random_state': 42
         }
         
+        self.backtest_config = {
+            'horizon': 24,  # Same horizon as predict_growth
+            'stride': 1,  # Hours between forecast origins; batching makes every hour cheap
+            'holdout_hours': 48,  # Trailing range kept out of training for the backtest
+            'batch_size': 1024
+        }
+        
         logger.info("SengonMLPipeline initialized")
 
     def fetch_sensor_data(self, device_id=None, hours=168):  # Default 7 days
@@ -93,39 +105,81 @@ class SengonMLPipeline:
             logger.error(f"Error fetching sensor data: {e}")
             return pd.DataFrame()
 
+    def resample_to_grid(self, df, columns=None):
+        """Align each device to a regular time grid, filling only short gaps"""
+        if columns is None:
+            columns = ['diameter_mm', 'temperature_c', 'humidity_percent', 'soil_moisture_percent']
+        max_gap = self.resample_config['max_gap_steps']
+        
+        frame = df[['device_id', 'time'] + columns].copy()
+        frame['time'] = pd.to_datetime(frame['time'])
+        
+        # Average readings per grid slot for all devices in one grouped pass;
+        # slots without readings between a device's first and last reading become NaN
+        grid = frame.set_index('time').groupby('device_id')[columns].resample(
+            self.resample_config['freq']).mean()
+        
+        values = grid.to_numpy(dtype=float)
+        missing = np.isnan(values)
+        device_codes = pd.factorize(grid.index.get_level_values('device_id'))[0]
+        device_start = np.r_[True, device_codes[1:] != device_codes[:-1]]
+        
+        # Number each run of missing slots per column (a run never crosses a device boundary)
+        # and measure its length, so long outages are left out instead of partially filled
+        run_ids = np.cumsum(~missing | device_start[:, None], axis=0)
+        gap_length = np.zeros(values.shape, dtype=int)
+        for j in range(values.shape[1]):
+            gap_length[:, j] = np.bincount(run_ids[:, j], weights=missing[:, j])[run_ids[:, j]]
+        
+        # Forward fill within each device only, then undo fills of long gaps
+        filled = grid.groupby(level='device_id').ffill().to_numpy(dtype=float, copy=True)
+        filled[missing & (gap_length > max_gap)] = np.nan
+        
+        result = pd.DataFrame(filled, columns=columns, index=grid.index).reset_index()
+        result['valid'] = ~np.isnan(filled).any(axis=1)
+        
+        logger.info(f"Resampled {len(df)} readings to {len(result)} grid slots "
+                    f"({int((~result['valid']).sum())} slots masked by outages)")
+        return result
+
+    def _valid_window_starts(self, valid, window_length):
+        """Start indices of windows that contain no masked grid slot"""
+        masked_before = np.r_[0, np.cumsum(~valid)]
+        starts = np.arange(max(len(valid) - window_length + 1, 0))
+        return starts[masked_before[starts + window_length] == masked_before[starts]]
+
     def preprocess_data_for_lstm(self, df):
         """Prepare data for LSTM training"""
         if len(df) == 0:
             return None, None, None
             
-        # Sort by device and time
-        df_sorted = df.sort_values(['device_id', 'time'])
-        
-        # Forward fill missing values
-        df_sorted = df_sorted.fillna(method='ffill').fillna(method='bfill')
-        
         # Create features
         features = ['diameter_mm', 'temperature_c', 'humidity_percent', 'soil_moisture_percent']
+        seq_len = self.lstm_config['sequence_length']
+        
+        grid = self.resample_to_grid(df, features)
         
         sequences = []
         targets = []
         
-        # Create sequences for each device
-        for device_id in df_sorted['device_id'].unique():
-            device_data = df_sorted[df_sorted['device_id'] == device_id][features].values
+        # Create sequences for each device, skipping windows that touch an outage
+        for device_id, device_grid in grid.groupby('device_id', sort=False):
+            device_data = device_grid[features].values
+            starts = self._valid_window_starts(device_grid['valid'].values, seq_len + 1)
             
-            # Create sequences
-            for i in range(len(device_data) - self.lstm_config['sequence_length']):
-                sequences.append(device_data[i:(i + self.lstm_config['sequence_length'])])
-                # Target is the next diameter reading
-                targets.append(device_data[i + self.lstm_config['sequence_length'], 0])  # diameter_mm
+            if len(starts) == 0:
+                continue
+                
+            sequences.append(device_data[starts[:, None] + np.arange(seq_len)])
+            # Target is the next diameter reading
+            targets.append(device_data[starts + seq_len, 0])  # diameter_mm
         
         if len(sequences) == 0:
             logger.warning("No sequences created for LSTM")
             return None, None, None
             
-        X = np.array(sequences)
-        y = np.array(targets)
+        X = np.concatenate(sequences)
+        y = np.concatenate(targets)
         
         # Scale the data
         scaler = MinMaxScaler()
@@ -287,37 +341,83 @@ class SengonMLPipeline:
                 
         return labels
 
-    def train_random_forest_health(self, df):
-        """Train Random Forest for health classification"""
-        # Create features
+    def build_training_features(self, df):
+        """Build one scaled float32 feature matrix shared by the RF and Isolation Forest"""
+        anomaly_cols = ['diameter_mm', 'growth_rate_mm_per_hour', 'temperature_c', 
+                       'humidity_percent', 'soil_moisture_percent']
+        
+        # Create features and labels
         df_features = self.create_health_features(df)
+        health_labels = np.asarray(self.create_health_labels(df_features))
+        
+        # Anomaly columns first so the Isolation Forest input is a leading column slice
+        feature_cols = anomaly_cols + [col for col in df_features.columns if col not in 
+                                       anomaly_cols + ['time', 'device_id']]
         
-        # Create labels
-        health_labels = self.create_health_labels(df_features)
-        df_features['health_status'] = health_labels
+        # Isolation Forest rows need the anomaly columns, RF rows need every feature
+        # and a known label, so RF rows are always a subset of Isolation Forest rows
+        anomaly_mask = df_features[anomaly_cols].notna().all(axis=1).to_numpy()
+        health_mask = (health_labels != 'unknown') & df_features[feature_cols].notna().all(axis=1).to_numpy()
         
-        # Remove rows with unknown labels or NaN
-        df_clean = df_features[df_features['health_status'] != 'unknown'].dropna()
+        if not anomaly_mask.any():
+            logger.error("No valid data for feature matrix")
+            return None
+            
+        # Order rows RF-first so the RF input is a leading row slice
+        rows = np.concatenate([np.flatnonzero(health_mask), np.flatnonzero(anomaly_mask & ~health_mask)])
+        X = np.ascontiguousarray(df_features[feature_cols].to_numpy(dtype=np.float32)[rows])
         
-        if len(df_clean) == 0:
+        # Scale in place with statistics shared by both models
+        scaler = StandardScaler()
+        X = scaler.fit(X).transform(X, copy=False)
+        X.flags.writeable = False
+        
+        logger.info(f"Built shared feature matrix {X.shape} ({X.nbytes / 1e6:.1f} MB float32), "
+                    f"{int(health_mask.sum())} rows for health classification")
+        
+        return {
+            'X': X,
+            'feature_cols': feature_cols,
+            'anomaly_cols': anomaly_cols,
+            'n_health': int(health_mask.sum()),
+            'health_labels': health_labels[health_mask],
+            'scaler': scaler
+        }
+
+    def _subset_scaler(self, scaler, n_features):
+        """Copy of a fitted StandardScaler restricted to its leading columns"""
+        subset = StandardScaler()
+        subset.mean_ = scaler.mean_[:n_features]
+        subset.var_ = scaler.var_[:n_features]
+        subset.scale_ = scaler.scale_[:n_features]
+        # Per-feature counts when the fit data contained NaNs, a scalar otherwise
+        if isinstance(scaler.n_samples_seen_, np.ndarray):
+            subset.n_samples_seen_ = scaler.n_samples_seen_[:n_features]
+        else:
+            subset.n_samples_seen_ = scaler.n_samples_seen_
+        subset.n_features_in_ = n_features
+        return subset
+
+    def train_random_forest_health(self, df, features=None):
+        """Train Random Forest for health classification"""
+        if features is None:
+            features = self.build_training_features(df)
+        
+        if features is None or features['n_health'] == 0:
             logger.error("No valid data for health classification")
             return False
             
-        # Select feature columns
-        feature_cols = [col for col in df_clean.columns if col not in 
-                       ['time', 'device_id', 'health_status']]
+        feature_cols = features['feature_cols']
         
-        X = df_clean[feature_cols]
-        y = df_clean['health_status']
+        # Read-only view of the shared matrix
+        X = features['X'][:features['n_health']]
+        y = features['health_labels']
         
-        # Scale features
-        scaler = StandardScaler()
-        X_scaled = scaler.fit_transform(X)
-        self.scalers['rf_health'] = scaler
+        self.scalers['rf_health'] = features['scaler']
         
         # Split data
         X_train, X_test, y_train, y_test = train_test_split(
-            X_scaled, y, test_size=0.2, random_state=42, stratify=y
+            X, y, test_size=0.2, random_state=42, stratify=y
         )
         
         # Train Random Forest
@@ -345,22 +445,28 @@ class SengonMLPipeline:
         
         return True
 
-    def train_anomaly_detection(self, df):
+    def train_anomaly_detection(self, df, features=None):
         """Train Isolation Forest for anomaly detection"""
-        # Prepare features for anomaly detection
-        feature_cols = ['diameter_mm', 'growth_rate_mm_per_hour', 'temperature_c', 
-                       'humidity_percent', 'soil_moisture_percent']
-        
-        X = df[feature_cols].dropna()
-        
-        if len(X) == 0:
-            logger.error("No data for anomaly detection")
-            return False
+        if features is not None:
+            # Read-only view of the shared matrix, already scaled
+            n_features = len(features['anomaly_cols'])
+            X_scaled = features['X'][:, :n_features]
+            self.scalers['anomaly'] = self._subset_scaler(features['scaler'], n_features)
+        else:
+            # Standalone call: only the anomaly columns are needed, skip the health features
+            feature_cols = ['diameter_mm', 'growth_rate_mm_per_hour', 'temperature_c', 
+                           'humidity_percent', 'soil_moisture_percent']
             
-        # Scale features
-        scaler = StandardScaler()
-        X_scaled = scaler.fit_transform(X)
-        self.scalers['anomaly'] = scaler
+            X = df[feature_cols].dropna()
+            
+            if len(X) == 0:
+                logger.error("No data for anomaly detection")
+                return False
+                
+            # Scale features
+            scaler = StandardScaler()
+            X_scaled = scaler.fit_transform(X.to_numpy(dtype=np.float32))
+            self.scalers['anomaly'] = scaler
         
         # Train Isolation Forest
         iso_forest = IsolationForest(
@@ -377,6 +483,131 @@ class SengonMLPipeline:
         logger.info("Anomaly detection model trained successfully")
         return True
 
+    def _recursive_forecast(self, X_scaled, steps_ahead, batch_size=None):
+        """Roll the LSTM forward for a batch of scaled sequences, one model call per step"""
+        n_samples, seq_len, n_features = X_scaled.shape
+        
+        # Preallocate the full rolled history so each step's input is a view, not a copy
+        history = np.empty((n_samples, seq_len + steps_ahead, n_features), dtype=X_scaled.dtype)
+        history[:, :seq_len, :] = X_scaled
+        predictions = np.empty((n_samples, steps_ahead), dtype=X_scaled.dtype)
+        
+        for step in range(steps_ahead):
+            pred = self.models['lstm'].predict(
+                history[:, step:step + seq_len, :], batch_size=batch_size, verbose=0
+            )
+            predictions[:, step] = pred[:, 0]
+            
+            # Update sequence (simple approach - use last known environmental values)
+            history[:, seq_len + step, :] = history[:, seq_len + step - 1, :]
+            history[:, seq_len + step, 0] = pred[:, 0]  # Update diameter prediction
+        
+        return predictions
+
+    def backtest_growth(self, df, horizon=None, stride=None, cutoff=None):
+        """Rolling-origin backtest of recursive growth forecasts over all devices"""
+        if 'lstm' not in self.models:
+            logger.error("LSTM model not loaded")
+            return None
+            
+        horizon = horizon or self.backtest_config['horizon']
+        stride = stride or self.backtest_config['stride']
+        seq_len = self.lstm_config['sequence_length']
+        features = ['diameter_mm', 'temperature_c', 'humidity_percent', 'soil_moisture_percent']
+        
+        if len(df) == 0:
+            logger.warning("No data for LSTM backtest")
+            return None
+            
+        grid = self.resample_to_grid(df, features)
+        
+        windows = []
+        targets = []
+        devices = []
+        
+        # Gather every forecast origin of every device into one batch
+        for device_id, device_grid in grid.groupby('device_id', sort=False):
+            device_data = device_grid[features].values
+            valid = device_grid['valid'].values
+            
+            # Origins need a full input window and at least one target; later targets
+            # are scored only while they stay inside the data and outside outages
+            starts = self._valid_window_starts(valid, seq_len + 1)
+            origins = starts[starts % stride == 0] + seq_len
+            
+            # Score only origins in the held-out range; earlier slots serve as input context
+            if cutoff is not None:
+                after_cutoff = (device_grid['time'] >= cutoff).to_numpy()
+                origins = origins[after_cutoff[origins]]
+            
+            if len(origins) == 0:
+                continue
+                
+            target_idx = origins[:, None] + np.arange(horizon)
+            masked_before = np.r_[0, np.cumsum(~valid)]
+            scored = ((target_idx < len(valid))
+                      & (masked_before[np.minimum(target_idx + 1, len(valid))] == masked_before[origins][:, None]))
+            
+            windows.append(device_data[origins[:, None] + np.arange(-seq_len, 0)])
+            targets.append(np.where(scored, device_data[np.minimum(target_idx, len(valid) - 1), 0], np.nan))  # diameter_mm
+            devices.append(device_id)
+        
+        if len(windows) == 0:
+            logger.warning(f"Not enough data for LSTM backtest (need {seq_len + 1} readings per device)")
+            return None
+            
+        X = np.concatenate(windows)
+        y = np.concatenate(targets)
+        
+        try:
+            X_scaled = self.scalers['lstm_features'].transform(X.reshape(-1, X.shape[-1])).reshape(X.shape)
+            
+            predictions_scaled = self._recursive_forecast(
+                X_scaled, horizon, batch_size=self.backtest_config['batch_size']
+            )
+            predictions = self.scalers['lstm_targets'].inverse_transform(
+                predictions_scaled.reshape(-1, 1)
+            ).reshape(predictions_scaled.shape)
+            
+        except Exception as e:
+            logger.error(f"Error in LSTM backtest: {e}")
+            return None
+            
+        # Per-horizon errors: column h holds every origin's (h+1)-step-ahead error,
+        # NaN where that target is past the end of the data or in an outage
+        errors = predictions - y
+        scored = ~np.isnan(errors)
+        counts = scored.sum(axis=0)
+        abs_errors = np.where(scored, np.abs(errors), 0.0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mae = abs_errors.sum(axis=0) / counts
+            rmse = np.sqrt((abs_errors ** 2).sum(axis=0) / counts)
+        
+        results = {
+            'created_at': datetime.now().isoformat(),
+            'horizon': horizon,
+            'stride': stride,
+            'cutoff': cutoff.isoformat() if cutoff is not None else None,
+            'n_origins': int(len(X)),
+            'devices': [str(device_id) for device_id in devices],
+            'n_origins_per_horizon': counts.tolist(),
+            # Horizons no origin reaches have no score
+            'mae': [None if n == 0 else float(v) for n, v in zip(counts, mae)],
+            'rmse': [None if n == 0 else float(v) for n, v in zip(counts, rmse)]
+        }
+        
+        logger.info(f"LSTM Backtest over {len(X)} origins "
+                    f"({counts[0]} scored at 1h, {counts[-1]} at {horizon}h) - "
+                    f"MAE: {mae[0]:.3f}mm (1h) / {mae[-1]:.3f}mm ({horizon}h), "
+                    f"RMSE: {rmse[0]:.3f}mm (1h) / {rmse[-1]:.3f}mm ({horizon}h)")
+        
+        # Save next to the model artifact
+        os.makedirs('models', exist_ok=True)
+        with open('models/lstm_backtest.json', 'w') as f:
+            json.dump(results, f, indent=2)
+        
+        return results
+
     def predict_growth(self, recent_data, steps_ahead=24):
         """Predict growth using LSTM model"""
         if 'lstm' not in self.models:
@@ -386,12 +617,17 @@ class SengonMLPipeline:
         try:
             # Prepare input data
             features = ['diameter_mm', 'temperature_c', 'humidity_percent', 'soil_moisture_percent']
-            X = recent_data[features].values
+            grid = self.resample_to_grid(recent_data, features)
+            X = grid[features].values
             
             if len(X) < self.lstm_config['sequence_length']:
                 logger.error("Not enough data for prediction")
                 return None
                 
+            if not grid['valid'].values[-self.lstm_config['sequence_length']:].all():
+                logger.error("Recent data contains an outage, cannot predict")
+                return None
+                
             # Take last sequence
             X_seq = X[-self.lstm_config['sequence_length']:].reshape(1, self.lstm_config['sequence_length'], len(features))
             
@@ -399,22 +635,11 @@ class SengonMLPipeline:
             X_scaled = self.scalers['lstm_features'].transform(X_seq.reshape(-1, X_seq.shape[-1])).reshape(X_seq.shape)
             
             # Predict
-            predictions = []
-            current_seq = X_scaled
-            
-            for _ in range(steps_ahead):
-                pred = self.models['lstm'].predict(current_seq, verbose=0)
-                predictions.append(pred[0, 0])
-                
-                # Update sequence (simple approach - use last known environmental values)
-                new_row = current_seq[0, -1, :].copy()
-                new_row[0] = pred[0, 0]  # Update diameter prediction
-                
-                current_seq = np.append(current_seq[:, 1:, :], new_row.reshape(1, 1, -1), axis=1)
+            predictions = self._recursive_forecast(X_scaled, steps_ahead)
             
             # Rescale predictions
             predictions_rescaled = self.scalers['lstm_targets'].inverse_transform(
-                np.array(predictions).reshape(-1, 1)
+                predictions.reshape(-1, 1)
             ).flatten()
             
             return predictions_rescaled
@@ -545,17 +770,31 @@ class SengonMLPipeline:
             logger.warning("Insufficient data for training. Need at least 100 records.")
             return False
         
-        # Train LSTM model
+        # Hold out a trailing time range so the backtest is out-of-sample
+        times = pd.to_datetime(df['time'])
+        cutoff = times.max() - pd.Timedelta(hours=self.backtest_config['holdout_hours'])
+        
+        # Fit on data before the cutoff and backtest on origins in the held-out range
+        logger.info(f"Training LSTM model for backtest on data before {cutoff}...")
+        if self.train_lstm_model(df[times < cutoff]):
+            logger.info("Backtesting LSTM growth forecasts...")
+            self.backtest_growth(df, cutoff=cutoff)
+        
+        # Refit on all fetched data; this is the model (and scalers) that gets deployed
         logger.info("Training LSTM model for growth prediction...")
         lstm_success = self.train_lstm_model(df)
         
+        # Build the feature matrix shared by both forests
+        logger.info("Building shared feature matrix...")
+        features = self.build_training_features(df)
+        
         # Train Random Forest for health classification
         logger.info("Training Random Forest for health classification...")
-        rf_success = self.train_random_forest_health(df)
+        rf_success = self.train_random_forest_health(df, features)
         
         # Train anomaly detection
         logger.info("Training anomaly detection model...")
-        anomaly_success = self.train_anomaly_detection(df)
+        anomaly_success = self.train_anomaly_detection(df, features)
         
         # Save all models
         self.save_models()
@@ -595,25 +834,30 @@ if __name__ == "__main__":
             logger.error("Failed to load models. Run training first.")
             exit(1)
         
-        # Get recent data
-        df = pipeline.fetch_sensor_data(device_id=args.device_id, hours=24)
+        # Get recent data, enough hourly slots for a full LSTM sequence plus slack for gaps
+        df = pipeline.fetch_sensor_data(device_id=args.device_id,
+                                        hours=pipeline.lstm_config['sequence_length'] + 24)
         
         if len(df) > 0:
             device_id = args.device_id or df['device_id'].iloc[0]
             device_data = df[df['device_id'] == device_id]
             
+            # Health and anomaly checks look at the last 24 hours only
+            times = pd.to_datetime(device_data['time'])
+            last_day = device_data[times >= times.max() - pd.Timedelta(hours=24)]
+            
             # Growth prediction
             growth_pred = pipeline.predict_growth(device_data)
             if growth_pred is not None:
                 logger.info(f"Growth prediction for next 24 hours: {growth_pred[:24]}")
             
             # Health prediction
-            health_pred = pipeline.predict_health(device_data)
+            health_pred = pipeline.predict_health(last_day)
             if health_pred:
                 logger.info(f"Health prediction: {health_pred}")
             
             # Anomaly detection
-            anomalies = pipeline.detect_anomalies(device_data)
+            anomalies = pipeline.detect_anomalies(last_day)
             if anomalies:
                 logger.info(f"Anomaly detection: {anomalies['anomaly_count']} anomalies found")
         